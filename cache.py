@@ -4,9 +4,15 @@
 
 __author__ = "fraser"
 
+import logging
+import re
 import sqlite3
+import threading
 import time
 import errno
+from calendar import timegm
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta, tzinfo
 from os import path, makedirs
 
@@ -15,13 +21,72 @@ try:
 except ImportError:
     import cPickle as cpickle
 
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+try:
+    from functools import lru_cache
+except ImportError:
+    def lru_cache(maxsize=128):
+        return lambda function: function
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
 
 HTTPDATE_FORMAT = "%a, %d %b %Y %H:%M:%S %Z"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"  # TIMESTAMP columns as written by sqlite3's datetime adapter
 DEFAULT_MAX_AGE = 60 * 60 * 24 * 365  # 1 year
-
+MEMORY_CACHE_SIZE = 512  # max fresh entries held in memory per Cache
+INCOMPRESSIBLE_TYPES = ("image/", "video/", "audio/")  # content types already compressed
+
+# cache-control directive, optionally with a token or quoted-string argument
+_CACHE_CONTROL_RE = re.compile(r'\s*([a-zA-Z0-9_-]+)(?:\s*=\s*("[^"]*"|[^,]*))?\s*(?:,|$)')
+
+# queries are kept constant so sqlite3's per connection statement cache reuses them
+_Q_GET = ("SELECT blob, last_modified, etag, immutable, fresh_until, "
+          "fresh_until > ? AS fresh, last_modified_str "
+          "FROM data WHERE uri=?")
+_Q_GET_BLOB = "SELECT blob FROM data WHERE uri=?"
+_Q_SET = ("REPLACE INTO data (uri, blob, http_date, "
+          "age, etag, expires, last_modified, max_age, immutable, fresh_until, host, last_modified_str) "
+          "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+_Q_TOUCH = ("UPDATE data SET http_date=?, age=?, expires=?, last_modified=?, max_age=?, fresh_until=?, "
+            "last_modified_str=? WHERE uri=?")
+_Q_DELETE = "DELETE FROM data WHERE uri=?"
+_Q_DOMAIN = "SELECT * FROM data WHERE host=? ORDER BY http_date LIMIT ?"
+_Q_STORE_RETRIEVE = "SELECT item FROM store_items WHERE key=?"
+_Q_STORE_EXISTS = "SELECT 1 FROM store_items WHERE key=? LIMIT 1"
+_Q_STORE_APPEND = "INSERT OR IGNORE INTO store_items VALUES(?, ?)"
+_Q_STORE_REMOVE = "DELETE FROM store_items WHERE key=? AND item=?"
+_Q_STORE_CLEAR = "DELETE FROM store_items WHERE key=?"
+_Q_STORE_BATCH_CREATE = "CREATE TEMP TABLE IF NOT EXISTS store_batch (item TEXT PRIMARY KEY)"
+_Q_STORE_BATCH_APPEND = "INSERT OR IGNORE INTO store_batch VALUES(?)"
+_Q_STORE_BATCH_CLEAR = "DELETE FROM store_batch"
+_Q_STORE_EXTEND = "INSERT OR IGNORE INTO store_items SELECT ?, item FROM store_batch"
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # 64 MiB
+    "PRAGMA mmap_size=1073741824",  # 1 GiB
+    "PRAGMA busy_timeout=3000",
+)
+
+@lru_cache(maxsize=2048)  # dates repeat heavily across responses and strptime is slow
 def httpdate_to_datetime(input_date):
     # type: (str) -> Union[None, datetime]
-    if input_date is None:
+    if not input_date:
         return None
     try:
         return datetime.strptime(input_date, HTTPDATE_FORMAT)
@@ -31,6 +96,19 @@ def httpdate_to_datetime(input_date):
         return None
 
 
+@lru_cache(maxsize=2048)
+def timestamp_to_datetime(input_date):
+    # type: (str) -> Union[None, datetime]
+    if not input_date:
+        return None
+    try:
+        return datetime.strptime(input_date[:19], TIMESTAMP_FORMAT)
+    except TypeError:
+        return datetime(*(time.strptime(input_date[:19], TIMESTAMP_FORMAT)[0:6]))
+    except ValueError:
+        return None
+
+
 def datetime_to_httpdate(input_date):
     # type: (datetime) -> Union[None, str]
     if input_date is None:
@@ -41,17 +119,42 @@ def datetime_to_httpdate(input_date):
         return None
 
 
+def _stored_httpdate(input_date):
+    # type: (str) -> Union[None, str]
+    """HTTP-date for a TIMESTAMP column, which holds naive GMT datetimes"""
+    value = timestamp_to_datetime(input_date)
+    return None if value is None else datetime_to_httpdate(value.replace(tzinfo=GMT()))
+
+
 def conditional_headers(row):
-    # type: (sqlite3.Row) -> dict
+    # type: (Union[CacheRow, dict]) -> dict
     """Creates conditional request header dict based on etag and last_modified"""
     headers = {}
     if row["etag"] is not None:
         headers["If-None-Match"] = row["etag"]
-    if row["last_modified"] is not None:
-        headers["If-Modified-Since"] = datetime_to_httpdate(row["last_modified"])
+    if row["last_modified_str"] is not None:
+        headers["If-Modified-Since"] = row["last_modified_str"]
+    elif row["last_modified"] is not None:
+        headers["If-Modified-Since"] = _stored_httpdate(row["last_modified"])
     return headers
 
 
+class CacheRow(namedtuple("CacheRow", "blob last_modified etag immutable fresh_until fresh last_modified_str")):
+    """Entry returned by Cache.get, fields read by attribute, index or by name like the dicts Cache.domain returns"""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return tuple.__getitem__(self, key)
+        if key not in self._fields:
+            raise IndexError("No item with that key")  # as sqlite3.Row
+        return getattr(self, key)
+
+    def keys(self):
+        # type: () -> list
+        return list(self._fields)
+
+
 class Store(object):
     """
     Generic unique string storage helper
@@ -68,42 +171,102 @@ class Store(object):
         """
         self.db = db
         self.key = key
+        self._local = threading.local()  # sqlite3 connections can only be used by the thread that opened them
+        self._migrated = False  # legacy data row for key checked
 
     def retrieve(self):
         # type: () -> set
         """Gets set of stored strings"""
-        with Cache(self.db) as c:
-            data = c.get(self.key)
-            return data["blob"] if data else set()
-
-    def _save(self, data):
-        # type: (set) -> None
-        """Saves set of strings"""
-        with Cache(self.db) as c:
-            if isinstance(data, set):
-                c.set(self.key, data)
+        cursor = self._open()._execute(_Q_STORE_RETRIEVE, (self.key,))
+        return set() if cursor is None else {row[0] for row in cursor}
 
     def append(self, item):
         # type: (str) -> None
         """Add string to the store"""
-        current = self.retrieve()
-        current.add(item)
-        self._save(current)
+        self._open()._execute(_Q_STORE_APPEND, (self.key, item))
+
+    def extend(self, items):
+        # type: (Iterable[str]) -> None
+        """
+        Add many strings to the store in a single transaction
+        Items are staged in a temp table so the store is written by a single sorted INSERT
+        Raises sqlite3.Error, with nothing added, if the transaction fails
+        """
+        connection = self._open().connection
+        # Automatically commits or rolls back on exception
+        with connection:
+            connection.execute(_Q_STORE_BATCH_CREATE)
+            connection.execute(_Q_STORE_BATCH_CLEAR)
+            connection.executemany(_Q_STORE_BATCH_APPEND, ((item,) for item in items))
+            connection.execute(_Q_STORE_EXTEND, (self.key,))
+            connection.execute(_Q_STORE_BATCH_CLEAR)
 
     def remove(self, item):
         # type: (str) -> None
         """Remove string from the store"""
-        current = self.retrieve()
-        current.remove(item)
-        self._save(current)
+        self._open()._execute(_Q_STORE_REMOVE, (self.key, item))
 
     def clear(self):
         # type: () -> None
         """Clears the store of all data"""
-        with Cache(self.db) as c:
-            c.delete(self.key)
-            
-            
+        self._open()._execute(_Q_STORE_CLEAR, (self.key,))
+
+    def close(self):
+        # type: () -> None
+        """
+        Closes the cache connection the calling thread holds for the store
+        Connections held by other threads are released when those threads end
+        """
+        cache = getattr(self._local, "cache", None)
+        if cache is not None:
+            cache.close()
+            self._local.cache = None
+
+    def _open(self):
+        # type: () -> Cache
+        """Lazily opens the calling thread's cache, which is then held until close()"""
+        cache = getattr(self._local, "cache", None)
+        if cache is None:
+            cache = self._local.cache = Cache(self.db)
+        if not self._migrated:
+            self._migrated = True
+            self._migrate(cache)
+        return cache
+
+    def _migrate(self, cache):
+        # type: (Cache) -> None
+        """
+        Moves this store, if saved by an earlier version as a pickled set
+        in the data table under key, into store_items
+        """
+        cursor = cache._execute(_Q_STORE_EXISTS, (self.key,))
+        if cursor is None or cursor.fetchone() is not None:
+            return
+        cursor = cache._execute(_Q_GET_BLOB, (self.key,))
+        row = None if cursor is None else cursor.fetchone()
+        if row is None:
+            return
+        try:
+            data = Blob.deserialise(row[0])
+        except Exception:
+            return  # unreadable here, leave it be
+        if not isinstance(data, set):
+            return
+        try:
+            with cache.connection:
+                cache.connection.executemany(_Q_STORE_APPEND, ((self.key, item) for item in data))
+                cache.connection.execute(_Q_DELETE, (self.key,))
+        except sqlite3.Error:
+            log.exception("unable to migrate store %s", self.key)
+        cache._mem.pop(self.key, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class GMT(tzinfo):
     """GMT Time Zone"""
 
@@ -118,18 +281,103 @@ class GMT(tzinfo):
 
 
 class Blob(object):
-    """Blob serialisation class"""
+    """
+    Blob serialisation class
+    Each blob is prefixed with a single tag byte, the low bits give the type:
+    raw bytes are stored as is, plain data (str keyed dicts, lists, str, numbers)
+    that msgpack round trips exactly is msgpack encoded when msgspec is available,
+    anything else, e.g. sets or tuples, is pickled.
+    The ZSTD bit marks a payload compressed with zstandard.
+    Untagged blobs are legacy pickles.
+    """
 
-    def __init__(self, data):
+    RAW = 0x00
+    MSGPACK = 0x01
+    PICKLE = 0x02
+    ZSTD = 0x10
+    MSGPACK_SCALARS = (type(u""), int, float, bool, type(None))
+    ZSTD_MIN_SIZE = 256  # smaller payloads aren't worth compressing
+
+    def __init__(self, data, compress=True):
         self.data = data
+        self.compress = compress
 
     def __conform__(self, protocol):
         if protocol is sqlite3.PrepareProtocol:
-            return sqlite3.Binary(cpickle.dumps(self.data, -1))
+            return sqlite3.Binary(self.serialise(self.data, self.compress))
+
+    @staticmethod
+    def serialise(data, compress=True):
+        # type: (Any, bool) -> bytes
+        if isinstance(data, bytes):
+            tag, payload = Blob.RAW, data
+        else:
+            tag, payload = Blob.PICKLE, None
+            if msgspec is not None and Blob._msgpack_exact(data):
+                try:
+                    tag, payload = Blob.MSGPACK, msgspec.msgpack.encode(data)
+                except (TypeError, ValueError, OverflowError):
+                    pass  # e.g. an int wider than 64 bits, fall back to pickle
+            if payload is None:
+                payload = cpickle.dumps(data, -1)
+        if compress and zstandard is not None and len(payload) >= Blob.ZSTD_MIN_SIZE:
+            compressed = _zstd_compressor().compress(payload)
+            if len(compressed) < len(payload):
+                tag, payload = tag | Blob.ZSTD, compressed
+        return bytes(bytearray((tag,))) + payload
 
     @staticmethod
     def deserialise(data):
-        return cpickle.loads(bytes(data))
+        # type: (bytes) -> Any
+        data = bytes(data)
+        tag = bytearray(data[:1])[0]
+        if tag & 0x80:
+            return cpickle.loads(data)  # pickle protocol 2+ opcode, untagged legacy blob
+        payload = data[1:]
+        if tag & Blob.ZSTD:
+            if zstandard is None:
+                raise ValueError("blob is zstd compressed but zstandard is not installed")
+            payload = _zstd_decompressor().decompress(payload)
+            tag &= ~Blob.ZSTD
+        if tag == Blob.RAW:
+            return payload
+        if tag == Blob.MSGPACK:
+            if msgspec is None:
+                raise ValueError("blob is msgpack encoded but msgspec is not installed")
+            return msgspec.msgpack.decode(payload)
+        return cpickle.loads(payload)
+
+    @staticmethod
+    def _msgpack_exact(data):
+        # type: (Any) -> bool
+        """True if msgpack decodes data back to the same types, it turns sets and tuples into lists"""
+        kind = type(data)
+        if kind is dict:
+            return all(type(key) is type(u"") and Blob._msgpack_exact(value) for key, value in data.items())
+        if kind is list:
+            return all(Blob._msgpack_exact(value) for value in data)
+        return kind in Blob.MSGPACK_SCALARS
+
+
+_zstd = threading.local()  # zstandard (de)compressors must not be shared between threads
+
+
+def _zstd_compressor():
+    # type: () -> zstandard.ZstdCompressor
+    if not hasattr(_zstd, "compressor"):
+        _zstd.compressor = zstandard.ZstdCompressor(level=3)
+    return _zstd.compressor
+
+
+def _zstd_decompressor():
+    # type: () -> zstandard.ZstdDecompressor
+    if not hasattr(_zstd, "decompressor"):
+        _zstd.decompressor = zstandard.ZstdDecompressor()
+    return _zstd.decompressor
+
+
+# process wide sqlite3 state, set once rather than on every connection
+sqlite3.enable_callback_tracebacks(True)
 
 
 class Cache(object):
@@ -141,101 +389,281 @@ class Cache(object):
 
     def __init__(self, name=None):
         self.connection = None
+        self._mem = OrderedDict()  # uri -> (fresh_until, row with serialised blob), least recently used first
+        self._data_version = None  # PRAGMA data_version the memory entries were valid for
+        self._bulk = False  # inside bulk(), which owns the transaction
         try:
             makedirs(path.dirname(name))
         except OSError as e:
             if e.errno != errno.EEXIST:
-                print(e.message)
+                log.exception("unable to create cache directory for %s", name)
                 return
         if name:
             self._open(name)
 
     def get(self, uri):
-        # type: (str) -> Union[None, sqlite.Row]
-        """Retrieve a partial entry from the cache"""
-        query = ("SELECT blob, last_modified, etag, immutable, "
-                 "CASE"
-                 "  WHEN max_age THEN max(age, max_age)"
-                 "  ELSE CASE"
-                 "      WHEN expires THEN expires - http_date"
-                 "      ELSE cast((datetime('now') - last_modified) / 10 as int)"
-                 "  END "
-                 "END >= strftime('%s', datetime('now')) - strftime('%s', http_date) AS fresh "
-                 "FROM data WHERE uri=?")
-        result = self._execute(query, (uri,))
-        return None if result is None else result.fetchone()
+        # type: (str) -> Union[None, CacheRow]
+        """
+        Retrieve a partial entry from the cache
+        Freshness, immutable entries included, is a single compare against the
+        precomputed fresh_until; immutable only skips revalidation while fresh (RFC 8246)
+        """
+        now = int(time.time())
+        self._sync_mem()
+        entry = self._mem.get(uri)
+        if entry is not None:
+            if now < entry[0]:
+                readable, blob = self._deserialise(uri, entry[1].blob)
+                if readable:
+                    self._mem[uri] = self._mem.pop(uri)  # mark as most recently used
+                    return entry[1]._replace(blob=blob)
+            del self._mem[uri]
+        cursor = self._execute(_Q_GET, (now, uri))
+        if cursor is None:
+            return None
+        cursor.row_factory = None  # plain tuple, cheaper than sqlite3.Row
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        readable, blob = self._deserialise(uri, row[0])
+        if not readable:
+            return None
+        stored = CacheRow(bytes(row[0]), *row[1:])
+        if stored.fresh:
+            self._remember(uri, stored.fresh_until, stored)
+        return stored._replace(blob=blob)
+
+    def get_blob(self, uri):
+        # type: (str) -> Any
+        """Retrieve only the stored data for uri, regardless of freshness, None if absent"""
+        self._sync_mem()
+        entry = self._mem.get(uri)
+        if entry is not None:
+            return self._deserialise(uri, entry[1].blob)[1]
+        cursor = self._execute(_Q_GET_BLOB, (uri,))
+        row = None if cursor is None else cursor.fetchone()
+        return None if row is None else self._deserialise(uri, row[0])[1]
 
     def set(self, uri, content, headers=None):
         # type: (str, Any, dict) -> None
         """Add or update a complete entry in the cache"""
-        if headers is None:
-            headers = {
-                "date": datetime_to_httpdate(datetime.now(GMT())),
-                "cache-control": "immutable, max-age={}".format(DEFAULT_MAX_AGE)
-            }
-        directives = self._parse_cache_control(headers.get("cache-control"))
-        if "no-store" in directives:
+        self.set_many(((uri, content, headers),))
+
+    def set_many(self, entries):
+        # type: (Iterable[tuple]) -> None
+        """Add or update complete entries, given as (uri, content, headers) tuples, in a single transaction"""
+        rows = []
+        remember = []
+        for uri, content, headers in entries:
+            if headers is None:
+                headers = {
+                    "date": datetime_to_httpdate(datetime.now(GMT())),
+                    "cache-control": "immutable, max-age={}".format(DEFAULT_MAX_AGE)
+                }
+            directives = self._parse_cache_control(headers.get("cache-control"))
+            if "no-store" in directives:
+                continue
+            fresh_until = self._fresh_until(headers, directives)
+            blob = Blob.serialise(content, not (headers.get("content-type") or "").startswith(INCOMPRESSIBLE_TYPES))
+            rows.append((
+                uri,
+                sqlite3.Binary(blob),
+                httpdate_to_datetime(headers.get("date")),
+                headers.get("age"),
+                headers.get("etag"),
+                httpdate_to_datetime(headers.get("expires")),
+                httpdate_to_datetime(headers.get("last-modified")),
+                directives.get("max-age"),
+                directives.get("immutable"),
+                fresh_until,
+                self._host(uri),
+                headers.get("last-modified")))
+            last_modified = httpdate_to_datetime(headers.get("last-modified"))
+            remember.append((uri, fresh_until, CacheRow(
+                blob,
+                None if last_modified is None else last_modified.isoformat(" "),
+                headers.get("etag"),
+                1 if directives.get("immutable") else None,
+                fresh_until,
+                1,
+                headers.get("last-modified"))))
+        if not rows or self._execute_many(_Q_SET, rows) is None:
             return
-        query = ("REPLACE INTO data (uri, blob, http_date, "
-                 "age, etag, expires, last_modified, max_age, immutable) "
-                 "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)")
-        values = (
-            uri,
-            Blob(content),
-            httpdate_to_datetime(headers.get("date")),
-            headers.get("age"),
-            headers.get("etag"),
-            httpdate_to_datetime(headers.get("expires")),
-            httpdate_to_datetime(headers.get("last-modified")),
-            directives.get("max-age"),
-            directives.get("immutable"))
-        self._execute(query, values)
+        for args in remember:
+            self._remember(*args)
 
     def touch(self, uri, headers):
         # type: (str, dict) -> None
         """Updates the meta data on an entry in the cache"""
+        self._mem.pop(uri, None)
         directives = self._parse_cache_control(headers.get("cache-control"))
-        query = "UPDATE data SET http_date=?, age=?, expires=?, last_modified=?, max_age=? WHERE uri=?"
         values = (
             httpdate_to_datetime(headers.get("date")),
             headers.get("age"),
             httpdate_to_datetime(headers.get("expires")),
             httpdate_to_datetime(headers.get("last-modified")),
             directives.get("max-age"),
+            self._fresh_until(headers, directives),
+            headers.get("last-modified"),
             uri)
-        self._execute(query, values)
+        self._execute(_Q_TOUCH, values)
 
     def delete(self, uri):
         # type: (str) -> None
         """Remove an entry from the cache via uri"""
-        query = "DELETE FROM data WHERE uri=?"
-        return self._execute(query, (uri,))
+        self._mem.pop(uri, None)
+        return self._execute(_Q_DELETE, (uri,))
 
     def domain(self, domain, limit=25):
         # type: (str, int) -> list
-        """Get items where uri like %domain%"""
-        query = "select * from data where uri like ? order by http_date limit ?"
-        cursor = self._execute(query, ('%{}%'.format(domain), limit))
-        return [] if cursor is None else cursor.fetchall()
+        """Get items, as dicts, whose uri host is domain, oldest first"""
+        cursor = self._execute(_Q_DOMAIN, (domain.lower(), limit))
+        if cursor is None:
+            return []
+        cursor.row_factory = self._row_factory
+        rows = []
+        for row in cursor.fetchall():
+            readable, row["blob"] = self._deserialise(row["uri"], row["blob"])
+            if readable:
+                rows.append(row)
+        return rows
+
+    @contextmanager
+    def bulk(self):
+        # type: () -> Iterator[Cache]
+        """
+        Runs a block of writes, e.g. rebuilding after clear(), as a single transaction
+        with syncing off, checkpointing the WAL once done
+        Rolls back if the block doesn't complete
+        """
+        sync_off = began = committed = False
+        try:
+            self.connection.execute("PRAGMA synchronous=OFF")
+            sync_off = True
+            self.connection.execute("BEGIN")
+            began = True
+            self._bulk = True
+            yield self
+            self.connection.commit()
+            committed = True
+        finally:
+            self._bulk = False
+            if began and not committed:
+                # any exit short of the commit, KeyboardInterrupt and GeneratorExit included
+                self.connection.rollback()
+                self._mem.clear()  # may hold entries that were rolled back
+            if sync_off:
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+            if began:
+                self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
     def clear(self):
         # type: () -> None
         """Truncates the cache data and vacuums"""
+        self._mem.clear()
         self._execute("DELETE FROM data")
+        self._execute("DELETE FROM store_items")
         self._execute("VACUUM")
 
+    @staticmethod
+    def _deserialise(uri, blob):
+        # type: (str, bytes) -> tuple
+        """Deserialises a stored blob as (True, data), or (False, None) if it can't be read by this process"""
+        try:
+            return True, Blob.deserialise(blob)
+        except ValueError:
+            log.warning("unable to read cached data for %s", uri, exc_info=True)
+            return False, None
+
+    def _sync_mem(self):
+        # type: () -> None
+        """Drops the memory entries once another connection has committed to the database"""
+        if not self._mem:
+            return
+        version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._mem.clear()
+            self._data_version = version
+
+    def _remember(self, uri, fresh_until, row):
+        # type: (str, Union[None, int], CacheRow) -> None
+        """
+        Holds a fresh entry, with its blob still serialised so callers never share it,
+        in memory so get() can skip sqlite, evicting the least recently used
+        """
+        self._mem.pop(uri, None)
+        if fresh_until is None or fresh_until <= time.time():
+            return
+        if not self._mem:
+            self._data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        self._mem[uri] = (fresh_until, row)
+        while len(self._mem) > MEMORY_CACHE_SIZE:
+            self._mem.popitem(last=False)
+
+    @staticmethod
+    def _fresh_until(headers, directives):
+        # type: (dict, dict) -> Union[None, int]
+        """
+        Epoch until which a response is fresh, fresh while now < fresh_until
+        i.e. freshness_lifetime > current_age, see: https://tools.ietf.org/html/rfc7234#section-4.2
+        """
+        return Cache._fresh_until_epoch(
+            httpdate_to_datetime(headers.get("date")),
+            httpdate_to_datetime(headers.get("expires")),
+            httpdate_to_datetime(headers.get("last-modified")),
+            directives.get("max-age"),
+            headers.get("age"))
+
+    @staticmethod
+    def _fresh_until_epoch(date, expires, last_modified, max_age, age):
+        # type: (datetime, datetime, datetime, int, str) -> Union[None, int]
+        """Epoch until which a response with the given parsed date, expires, etc. is fresh"""
+        if date is None:
+            return None
+        date = timegm(date.timetuple())
+        if max_age is not None:
+            # a malformed max-age, e.g. max-age=abc, makes the response stale
+            lifetime = max_age if isinstance(max_age, int) and not isinstance(max_age, bool) else 0
+        elif expires is not None:
+            lifetime = timegm(expires.timetuple()) - date
+        elif last_modified is not None:
+            lifetime = (date - timegm(last_modified.timetuple())) // 10
+        else:
+            return None
+        try:
+            age = int(age or 0)
+        except ValueError:
+            age = 0
+        return date + lifetime - age
+
+    @staticmethod
+    def _host(uri):
+        # type: (str) -> Union[None, str]
+        """Lowercase host name of a uri, None for keys that aren't urls"""
+        try:
+            return urlsplit(uri).hostname
+        except ValueError:
+            return None
+
     @staticmethod
     def _parse_cache_control(header):
         # type: (str) -> dict
         # format: https://tools.ietf.org/html/rfc7234#section-5.2
         if header is None:
             return {}
-        return {
-            parts[0].strip():
-                [int(parts[1]) if len(parts) > 1 else True][0]
-            for directive in header.split(",")
-            for parts in [directive.split("=")]
-        }
+        directives = {}
+        for match in _CACHE_CONTROL_RE.finditer(header):
+            name, value = match.groups()
+            if value is None:
+                value = True
+            else:
+                value = value.strip().strip('"')
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass  # token or quoted-string argument, e.g. private="set-cookie"
+            directives[name.lower()] = value
+        return directives
 
     @staticmethod
     def _row_factory(cursor, row):
@@ -248,32 +676,42 @@ class Cache(object):
         if values is None:
             values = ()
         try:
+            if self._bulk:
+                return self.connection.execute(query, values)
             # Automatically commits or rolls back on exception
             with self.connection:
                 return self.connection.execute(query, values)
-        except (sqlite3.IntegrityError, sqlite3.OperationalError) as e:
-            print(e.message)
+        except sqlite3.Error:
+            log.exception("sqlite failed: %s", query)
+
+    def _execute_many(self, query, values):
+        # type (str, Iterable[tuple]) -> Union[None, sqlite3.Cursor]
+        try:
+            if self._bulk:
+                return self.connection.executemany(query, values)
+            # Automatically commits or rolls back on exception
+            with self.connection:
+                return self.connection.executemany(query, values)
+        except sqlite3.Error:
+            log.exception("sqlite failed: %s", query)
 
     def _open(self, name):
         # type: (str) -> None
-        sqlite3.enable_callback_tracebacks(True)
-        sqlite3.register_converter("BLOB", Blob.deserialise)
         try:
-            self.connection = sqlite3.connect(name,
-                                              timeout=1,
-                                              detect_types=sqlite3.PARSE_DECLTYPES)
-        except sqlite3.Error as e:
-            print(e.message)
+            self.connection = sqlite3.connect(name, timeout=1)
+        except sqlite3.Error:
+            log.exception("unable to open cache %s", name)
             return
         # see: https://docs.python.org/2/library/sqlite3.html#sqlite3.Connection.row_factory
         self.connection.row_factory = sqlite3.Row
         self.connection.text_factory = sqlite3.OptimizedUnicode
+        # per connection tuning, see: https://www.sqlite.org/pragma.html
+        self.connection.executescript(";".join(PRAGMAS))
         self._create_table()
 
-    def _close(self):
+    def close(self):
         # type: () -> None
         """Closes any open connection and cursor"""
-        del sqlite3.converters["BLOB"]  
         if self.connection:
             self.connection.cursor().close()
             self.connection.close()
@@ -289,14 +727,56 @@ class Cache(object):
                 "expires TIMESTAMP,"
                 "last_modified TIMESTAMP,"
                 "max_age INTEGER,"
-                "immutable INTEGER DEFAULT 0"
+                "immutable INTEGER DEFAULT 0,"
+                "fresh_until INTEGER,"
+                "host TEXT,"
+                "last_modified_str TEXT"
                 ")")
         self._execute(query)
+        self._migrate()
+        self._execute("CREATE INDEX IF NOT EXISTS idx_data_host_date ON data(host, http_date)")
+        query = ("CREATE TABLE IF NOT EXISTS store_items ("
+                 "key TEXT NOT NULL,"
+                 "item TEXT NOT NULL,"
+                 "PRIMARY KEY (key, item)"
+                 ") WITHOUT ROWID")
+        self._execute(query)
+
+    def _migrate(self):
+        # type: () -> None
+        """Adds columns missing from a data table created by an earlier version"""
+        cursor = self._execute("PRAGMA table_info(data)")
+        columns = set() if cursor is None else {row["name"] for row in cursor}
+        for name, declaration in (("fresh_until", "INTEGER"), ("host", "TEXT"), ("last_modified_str", "TEXT")):
+            if name not in columns:
+                self._execute("ALTER TABLE data ADD COLUMN {} {}".format(name, declaration))
+        if not columns.issuperset(("host", "fresh_until", "last_modified_str")):
+            cursor = self._execute("SELECT uri, http_date, expires, last_modified, max_age, age, host, fresh_until, "
+                                   "last_modified_str FROM data")
+            if cursor is not None:
+                rows = []
+                for (uri, http_date, expires, last_modified, max_age, age,
+                     host, fresh_until, last_modified_str) in cursor.fetchall():
+                    if "host" not in columns:
+                        host = self._host(uri)
+                    if "fresh_until" not in columns:
+                        fresh_until = self._fresh_until_epoch(
+                            timestamp_to_datetime(http_date),
+                            timestamp_to_datetime(expires),
+                            timestamp_to_datetime(last_modified),
+                            max_age,
+                            age)
+                    if "last_modified_str" not in columns:
+                        last_modified_str = _stored_httpdate(last_modified)
+                    rows.append((host, fresh_until, last_modified_str, uri))
+                self._execute_many("UPDATE data SET host=?, fresh_until=?, last_modified_str=? WHERE uri=?", rows)
+        # superseded by idx_data_host_date
+        self._execute("DROP INDEX IF EXISTS idx_data_http_date")
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._close()
+        self.close()
 
 